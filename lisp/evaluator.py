@@ -7,6 +7,9 @@ import sys
 import logging
 import traceback
 import re
+import time
+import itertools
+import contextlib
 
 DEBUG=False
 
@@ -75,6 +78,8 @@ def lisp_load(env, filename):
         term = parser.read()
         try:
             term.eval(env)
+        except ResourceLimitError:
+            raise
         except Exception as e:
             raise SyntaxError('Eval error: %s' % e)
     return None
@@ -93,16 +98,231 @@ def lisp_format(env, format, *args):
     return result
 
 
+class ResourceLimitError(SyntaxError):
+    """
+    Raised when an evaluation runs past a limit set on its EvalContext
+    """
+    pass
+
+
+class EvalContext(object):
+    """
+    Resource limits and counters for top level evaluations.
+
+    Limits are optional: max_steps bounds the number of s-expression
+    reductions, max_depth the number of nested function applications,
+    and timeout the wall clock seconds per evaluation.  After eval()
+    returns (or raises) steps, calls, peak_depth and elapsed describe
+    the work done.  peak_depth is the deepest nesting of function
+    applications seen, the same quantity max_depth limits.
+
+    Each application takes a few python stack frames, so python's own
+    recursion limit is reached somewhere around sys.getrecursionlimit()
+    / 3 nested applications.  That is reported as a ResourceLimitError
+    too, so a max_depth above it just means "as deep as python allows".
+    """
+    # how many steps between wall clock checks when a timeout is set
+    check_interval = 1024
+
+    def __init__(self, max_steps=None, max_depth=None, timeout=None):
+        self.max_steps = max_steps
+        self.max_depth = max_depth
+        self.timeout = timeout
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.calls = 0
+        self.depth = 0
+        self.peak_depth = 0
+        self.elapsed = 0.0
+        self.depth_limit = sys.maxint if self.max_depth is None else self.max_depth
+        self.deadline = None if self.timeout is None else time.time() + self.timeout
+        self.next_check = self.find_next_check()
+
+    def find_next_check(self):
+        """
+        Step count at which check() next needs to run.  Keeping this as a
+        single number means SExpr.eval only does one compare per step.
+        """
+        next_check = sys.maxint
+        if self.deadline is not None:
+            next_check = self.steps + self.check_interval
+        if self.max_steps is not None:
+            next_check = min(next_check, self.max_steps + 1)
+        return next_check
+
+    def check(self):
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise ResourceLimitError('Step limit of %d exceeded' % self.max_steps)
+        if self.deadline is not None and time.time() > self.deadline:
+            raise ResourceLimitError('Timeout of %ss exceeded' % self.timeout)
+        self.next_check = self.find_next_check()
+
+    def apply(self, fn, env, args):
+        self.calls += 1
+        self.depth += 1
+        try:
+            if self.depth > self.peak_depth:
+                self.peak_depth = self.depth
+                if self.depth > self.depth_limit:
+                    raise ResourceLimitError('Recursion depth of %d exceeded' % self.max_depth)
+            return fn.invoke(env, args)
+        finally:
+            self.depth -= 1
+
+    @contextlib.contextmanager
+    def attached(self, env):
+        """
+        Reset the counters and enforce limits on everything evaluated in
+        env's top environment for the duration of a with block.  Limits
+        and counters cover the whole block, not each evaluation in it.
+        """
+        root = env.root
+        previous = root.context
+        root.context = self
+        self.reset()
+        start = time.time()
+        try:
+            yield self
+        except RuntimeError as e:
+            if 'maximum recursion depth' not in str(e):
+                raise
+            raise ResourceLimitError('Recursion depth exceeded python stack at depth %d' %
+                                     self.peak_depth)
+        finally:
+            self.elapsed = time.time() - start
+            root.context = previous
+
+    def eval(self, term, env):
+        """
+        Evaluate term in env with counters reset and limits enforced.
+        """
+        with self.attached(env):
+            return term.eval(env)
+
+    def stats(self):
+        return {'steps': self.steps,
+                'calls': self.calls,
+                'peak_depth': self.peak_depth,
+                'elapsed': self.elapsed}
+
+
+def symbols_in(expr):
+    """
+    Return the set of every symbol name appearing anywhere in expr
+    """
+    if isinstance(expr, Symbol):
+        return set([expr.name])
+    result = set()
+    if isinstance(expr, SExpr):
+        for term in expr.value:
+            result |= symbols_in(term)
+    return result
+
+
+def free_variables(expr):
+    """
+    Return the set of symbol names expr refers to without binding them
+    itself.  This is conservative: anything that isn't a recognized
+    binding form just unions the free variables of its elements, and
+    quoted data counts as referring to every symbol in it, since it
+    may be passed to eval.
+    """
+    if isinstance(expr, Symbol):
+        return set([expr.name])
+    if not isinstance(expr, SExpr) or not expr.value:
+        return set()
+
+    x = expr.value
+    head = x[0].name if isinstance(x[0], Symbol) else None
+
+    if head in ('quote', 'quasiquote'):
+        return symbols_in(expr)
+    if head == 'lambda' and len(x) == 3 and isinstance(x[1], SExpr):
+        return free_variables(x[2]) - set([f.name for f in x[1].value])
+    if head in ('let', 'let*', 'letrec') and len(x) == 3 and isinstance(x[1], SExpr) and \
+       all(isinstance(pair, SExpr) and len(pair.value) == 2 and
+           isinstance(pair.value[0], Symbol) for pair in x[1].value):
+        pairs = [pair.value for pair in x[1].value]
+        if head == 'let':
+            result = free_variables(x[2]) - set([key.name for key, value in pairs])
+            for key, value in pairs:
+                result |= free_variables(value)
+        elif head == 'letrec':
+            result = free_variables(x[2])
+            for key, value in pairs:
+                result |= free_variables(value)
+            result -= set([key.name for key, value in pairs])
+        else:
+            result = free_variables(x[2])
+            for key, value in reversed(pairs):
+                result = (result - set([key.name])) | free_variables(value)
+        return result
+
+    result = set()
+    for term in x:
+        result |= free_variables(term)
+    return result
+
+
+# value of a letrec variable before its init expression has run
+UNINITIALIZED = object()
+
+
+class Cell(object):
+    """
+    A mutable slot holding the value of a local variable, so closures
+    can share it with the frame that bound it.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
 class Environment(object):
     """
     The Environment class have a hash table as its lookup data structure,
     and a pointer pointed to its parent environment. The top environment
     has its prev set to None
+
+    The top environment maps names straight to values.  Every other
+    frame maps names to Cells.
+
+    Call sites cache the global function they resolve to (see SExpr.eval).
+    Those caches are only valid while the top environment's version is
+    unchanged, so anything that rebinds a name that is not in its
+    local_names must bump it.  local_names holds every name ever bound
+    by a lambda or let under that top environment, since those may
+    shadow a global at some call site.
+
+    The top environment also carries the EvalContext (if any) that is
+    currently evaluating in it.
     """
-    def __init__(self, prev=None, env={}):
-        self.env = env
+    def __init__(self, prev=None, env=None):
+        self.env = env if env is not None else {}
         self.prev = prev
 
+        if prev is None:
+            self.root = self
+            self.context = None
+            self.version = 0
+            self.local_names = set()
+        else:
+            self.root = prev.root
+
+    def bind_local_names(self, names):
+        """
+        Record names that can be bound in a non-top-level frame,
+        invalidating call site caches if any of them are new.
+        """
+        root = self.root
+        for name in names:
+            if name not in root.local_names:
+                root.local_names.add(name)
+                root.version += 1
+
     def get(self, symbol):
         """
         Lookup in the current environment. If the symbol does not exist.
@@ -121,9 +341,25 @@ class Environment(object):
                 return result
 
         result = self.env[symbol]
+        if self.prev is not None:
+            result = result.value
+            if result is UNINITIALIZED:
+                raise SyntaxError('Variable %s used before initialization' % symbol)
         logging.debug('Directly resolved %s to %s' % (symbol, result))
         return result
 
+    def get_cell(self, symbol):
+        """
+        Return the Cell a local frame holds for symbol, or None if
+        it is only bound (if at all) in the top environment.
+        """
+        current = self
+        while current.prev is not None:
+            if symbol in current.env:
+                return current.env[symbol]
+            current = current.prev
+        return None
+
     def set(self, symbol, value, with_create = False):
         logging.debug('setting symbol "%s"' % symbol)
         if not symbol in self.env and not with_create:
@@ -132,7 +368,20 @@ class Environment(object):
             else:
                 return self.prev.set(symbol, value, with_create)
 
-        self.env[symbol] = value
+        if self.prev is not None and symbol not in self.env:
+            # a new local binding can shadow a cached global
+            self.bind_local_names([symbol])
+
+        root = self.root
+        if symbol not in root.local_names:
+            root.version += 1
+
+        if self.prev is None:
+            self.env[symbol] = value
+        elif symbol in self.env:
+            self.env[symbol].value = value
+        else:
+            self.env[symbol] = Cell(value)
 
     def flat_clone(self):
         """
@@ -146,12 +395,25 @@ class Environment(object):
 
         cloned_dict = {}
         for env in reverse_list:
-            cloned_dict.update(copy.deepcopy(env.env))
+            if env.prev is None:
+                values = env.env
+            else:
+                values = dict((k, cell.value) for k, cell in env.env.iteritems())
+            cloned_dict.update(copy.deepcopy(values))
 
-        return Environment(prev=None, env=cloned_dict)
+        clone = Environment(prev=None, env=cloned_dict)
+        clone.local_names = set(self.root.local_names)
+        return clone
 
-    def extend(self, extended_environment={}):
-        return Environment(prev=self, env=extended_environment)
+    def extend(self, extended_environment=None):
+        """
+        Create a child frame binding the names in extended_environment
+        """
+        env = {}
+        if extended_environment is not None:
+            self.bind_local_names(extended_environment)
+            env = dict((k, Cell(v)) for k, v in extended_environment.iteritems())
+        return Environment(prev=self, env=env)
 
 
 class Token(object):
@@ -159,18 +421,40 @@ class Token(object):
 
 
 class Function(object):
-    pass
+    def pyvalue(self, env, deep=False):
+        # functions have no python equivalent, so hand back the object
+        return self
+
+    def check_arity(self, nargs):
+        pass
+
+    def eval(self, env, *args):
+        self.check_arity(len(args))
+        return self.invoke(env, args)
 
 
 class LambdaFunction(Function):
     """
     This class represent lisp lambda expression: (lambda (args) body)
+
+    Rather than the whole defining environment, a lambda keeps the cells
+    of the free variables in its body that are bound locally where it
+    was created, plus the top environment to look up everything else.
     """
-    def __init__(self, env, formals, fn):
+    def __init__(self, env, formals, fn, free_names=None):
+        env.bind_local_names(formals)
         self.name = 'lambda#%s' % id(self)
         self.formals = formals
         self.fn = fn
-        self.env = env
+        self.root = env.root
+
+        if free_names is None:
+            free_names = free_variables(fn) - set(formals)
+
+        captured = [(name, env.get_cell(name)) for name in free_names]
+        captured = [(name, cell) for name, cell in captured if cell is not None]
+        self.free = tuple(name for name, cell in captured)
+        self.cells = tuple(cell for name, cell in captured)
 
     def __str__(self):
         return '%s(%s)' % (self.name, ' '.join(self.formals))
@@ -178,13 +462,20 @@ class LambdaFunction(Function):
     def lispy_str(self):
         return '#fn#'
 
-    def eval(self, env, *args):
-        if len(args) != len(self.formals):
+    def check_arity(self, nargs):
+        if nargs != len(self.formals):
             raise SyntaxError('Function %s expects %d args, got %d' % (
-                len(self.formals), len(args)))
+                self.name, len(self.formals), nargs))
 
-        lambda_env = env.extend(self.env.env).extend(dict(zip(self.formals, [x.eval(env) for x in args])))
-        return self.fn.eval(lambda_env)
+    def invoke(self, env, args):
+        """
+        Apply the function without checking arity.  Callers must have
+        already done check_arity for this number of args.
+        """
+        frame = dict(zip(self.free, self.cells))
+        for formal, arg in zip(self.formals, args):
+            frame[formal] = Cell(arg.eval(env))
+        return self.fn.eval(Environment(prev=self.root, env=frame))
 
 
 class InternalFunction(Function):
@@ -204,7 +495,7 @@ class InternalFunction(Function):
     def lispy_str(self):
         return self.name
 
-    def eval(self, env, *args):
+    def invoke(self, env, args):
         real_args = [arg.eval(env) for arg in args]
 
         if self.translate:
@@ -230,6 +521,15 @@ class SExpr(Token):
     def __init__(self, value):
         self.value = value
 
+        # call site cache: the function this expression last applied,
+        # valid while the global env and its version are unchanged
+        self.cache_version = None
+        self.cache_root = None
+        self.cache_fn = None
+
+        # for lambda forms, the free variables of the body
+        self.free_names = None
+
     def __repr__(self):
         return 'Sexpr: %s' % self.value
 
@@ -243,10 +543,20 @@ class SExpr(Token):
         return self.value
         
     def eval(self, env):
-        fn = None
+        root = env.root
+        context = root.context
+        if context is not None:
+            context.steps += 1
+            if context.steps >= context.next_check:
+                context.check()
 
         x = self.value
 
+        if self.cache_root is root and self.cache_version == root.version:
+            if context is None:
+                return self.cache_fn.invoke(env, x[1:])
+            return context.apply(self.cache_fn, env, x[1:])
+
         if isinstance(x[0], Symbol):
             if x[0].name == 'if':
                 (test, if_true, if_false) = x[1:]
@@ -280,6 +590,7 @@ class SExpr(Token):
                 new_env = env.extend()
                 for pair in pairslist.pyvalue(env):
                     (key, value) = pair.pyvalue(env)
+                    env.bind_local_names([key.name])
                     new_env.set(key.name, value.eval(env), with_create = True)
                 return expr.eval(new_env)
             if x[0].name == 'let*':
@@ -287,15 +598,29 @@ class SExpr(Token):
                 new_env = env.extend()
                 for pair in pairslist.pyvalue(env):
                     (key, value) = pair.pyvalue(env)
+                    env.bind_local_names([key.name])
                     new_env.set(key.name, value.eval(new_env), with_create = True)
                 return expr.eval(new_env)
+            if x[0].name == 'letrec':
+                (pairslist, expr) = x[1:]
+                pairs = [pair.pyvalue(env) for pair in pairslist.pyvalue(env)]
+                names = [key.name for (key, value) in pairs]
+                env.bind_local_names(names)
+                # bind every name first, so lambdas can capture each other
+                new_env = env.extend(dict((name, UNINITIALIZED) for name in names))
+                for (key, value) in pairs:
+                    new_env.set(key.name, value.eval(new_env))
+                return expr.eval(new_env)
             if x[0].name == 'begin':
                 for expr in x[1:]:
                     result = expr.eval(env)
                 return result
             if x[0].name == 'lambda':
                 (formals, expr) = x[1:]
-                return LambdaFunction(env, [x.name for x in formals.value], expr)
+                formals = [f.name for f in formals.value]
+                if self.free_names is None:
+                    self.free_names = tuple(free_variables(expr) - set(formals))
+                return LambdaFunction(env, formals, expr, self.free_names)
 
         fn = x[0].eval(env)
         # if isinstance(x[0], Symbol):
@@ -304,7 +629,19 @@ class SExpr(Token):
         if not isinstance(fn, Function):
             raise SyntaxError('%s: %s is not a function' % (x[0], x[0].__class__.__name__))
 
-        return fn.eval(env, *self.value[1:])
+        args = x[1:]
+        fn.check_arity(len(args))
+
+        # a name that was never bound locally can only resolve to the
+        # global env, so remember the function for next time
+        if isinstance(x[0], Symbol) and x[0].name not in root.local_names:
+            self.cache_version = root.version
+            self.cache_root = root
+            self.cache_fn = fn
+
+        if context is None:
+            return fn.invoke(env, args)
+        return context.apply(fn, env, args)
         
 
 class Symbol(Token):
@@ -430,6 +767,164 @@ class Parser(object):
         return val
 
 
+def box_value(value):
+    """
+    Convert a python value into the lisp token that represents it
+    """
+    if isinstance(value, Token):
+        return value
+    if isinstance(value, (int, long)):
+        return ConstantInt(value)
+    if isinstance(value, float):
+        return ConstantFloat(value)
+    if isinstance(value, basestring):
+        return ConstantString(value)
+    if isinstance(value, (list, tuple)):
+        return SExpr([box_value(x) for x in value])
+    return Constant(value)
+
+
+class Interpreter(object):
+    """
+    Python embedding interface.  Holds a global environment that
+    definitions can be loaded into with run(), and compiles expressions
+    to be evaluated against many sets of input bindings.
+    """
+    def __init__(self, env=None, context=None):
+        self.env = env if env is not None else generate_global_env()
+        self.context = context
+
+    def eval_term(self, term, env):
+        if self.context is None:
+            return term.eval(env)
+        return self.context.eval(term, env)
+
+    def run(self, source):
+        """
+        Evaluate every term in source at top level, returning the python
+        value of the last one.
+        """
+        parser = Parser(source)
+        result = None
+        while not parser.EOF():
+            result = self.eval_term(parser.read(), self.env)
+
+        if result is None:
+            return None
+        return result.pyvalue(self.env, deep=True)
+
+    def compile(self, source, inputs=()):
+        return CompiledExpr(self, source, inputs)
+
+
+class CompiledExpr(object):
+    """
+    An expression parsed once, to be evaluated with different values
+    bound to its input names.
+
+    Evaluation reuses a single frame for the inputs.  Each record gets
+    fresh cells and tokens in it, so anything that keeps hold of an
+    input (a set! global, an escaping closure) still sees the value of
+    its own record.  After eval_many() or eval_columns(), records,
+    elapsed and records_per_second describe the last batch.  If the
+    interpreter has an EvalContext, its limits and counters cover the
+    batch as a whole.
+    """
+    def __init__(self, interpreter, source, inputs=()):
+        parser = Parser(source)
+        terms = []
+        while not parser.EOF():
+            terms.append(parser.read())
+
+        if not terms:
+            raise SyntaxError('Nothing to compile')
+        if len(terms) == 1:
+            self.term = terms[0]
+        else:
+            self.term = SExpr([Symbol('begin')] + terms)
+
+        self.interpreter = interpreter
+        self.inputs = tuple(inputs)
+
+        # inputs shadow globals, just like lambda formals
+        interpreter.env.bind_local_names(self.inputs)
+        self.frame = interpreter.env.extend(dict((name, None) for name in self.inputs))
+
+        self.records = 0
+        self.elapsed = 0.0
+
+    def bind(self, values):
+        frame = self.frame.env
+        for name, value in itertools.izip(self.inputs, values):
+            frame[name] = Cell(box_value(value))
+
+    def unbox(self, result):
+        if result is None:
+            return None
+        if isinstance(result, Constant):
+            return result.value
+        return result.pyvalue(self.frame, deep=True)
+
+    def eval(self, bindings=None, **kwargs):
+        """
+        Evaluate against a single record, given as a dict and/or keywords.
+        """
+        record = dict(bindings or {}, **kwargs)
+        self.bind([record[name] for name in self.inputs])
+        return self.unbox(self.interpreter.eval_term(self.term, self.frame))
+
+    def eval_rows(self, rows):
+        context = self.interpreter.context
+        if context is None:
+            return self.eval_batch(rows)
+
+        with context.attached(self.frame):
+            return self.eval_batch(rows)
+
+    def eval_batch(self, rows):
+        results = []
+        term = self.term
+        frame = self.frame
+
+        start = time.time()
+        for values in rows:
+            self.bind(values)
+            results.append(self.unbox(term.eval(frame)))
+
+        self.elapsed = time.time() - start
+        self.records = len(results)
+        return results
+
+    def eval_many(self, records):
+        """
+        Evaluate against each dict in records, returning a list of results
+        """
+        inputs = self.inputs
+        return self.eval_rows([record[name] for name in inputs] for record in records)
+
+    def eval_columns(self, columns):
+        """
+        Evaluate against a dict of equal length sequences, one per input
+        """
+        columns = [columns[name] for name in self.inputs]
+        if len(set(len(column) for column in columns)) > 1:
+            raise SyntaxError('Columns have different lengths: %s' % ', '.join(
+                '%s=%d' % (name, len(column)) for name, column in zip(self.inputs, columns)))
+
+        return self.eval_rows(itertools.izip(*columns))
+
+    @property
+    def records_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.records / self.elapsed
+
+    def stats(self):
+        return {'records': self.records,
+                'elapsed': self.elapsed,
+                'records_per_second': self.records_per_second}
+
+
 def generate_global_env():
     """
     initialize top level environment
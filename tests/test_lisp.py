@@ -1,10 +1,13 @@
 import os
 import sys
 import copy
+import gc
+import weakref
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from lisp import Parser, generate_global_env
+from lisp import Parser, generate_global_env, EvalContext, ResourceLimitError, Interpreter, Constant, \
+    ConstantInt, LambdaFunction
 
 #from lisp import Parser, global_env, generate_global_env
 from nose.tools import *
@@ -160,3 +163,237 @@ class TestLisp:
         assert(self.eval_expr("(car (cdr '(1 2 3)))") == 2)
 
     
+
+    # test call site caching
+    def t3000_test_redefine_after_call(self):
+        assert(self.eval_expr('(define f (lambda (x) 1))(define g (lambda () (f 0)))'
+                              '(g)(define f (lambda (x) 2))(g)') == 2)
+
+    def t3010_test_set_after_call(self):
+        assert(self.eval_expr('(define f (lambda (x) 1))(define g (lambda () (f 0)))'
+                              '(g)(set! f (lambda (x) 3))(g)') == 3)
+
+    def t3020_test_local_shadows_cached_global(self):
+        assert(self.eval_expr("(define h (lambda () 1))(define e '(h))"
+                              "(eval e)((lambda (h) (eval e)) (lambda () 2))") == 2)
+
+    @raises(SyntaxError)
+    def t3030_test_lambda_arity(self):
+        self.eval_expr('(define f (lambda (x) x))(f 1 2)')
+
+    def t3040_test_caches_are_per_environment(self):
+        env1 = generate_global_env()
+        env2 = generate_global_env()
+        Parser('(lambda (f) (f))').read().eval(env1)
+        assert('f' in env1.local_names)
+        assert('f' not in env2.local_names)
+        version = env2.version
+        Parser('(define x 1)').read().eval(env1)
+        assert(env2.version == version)
+
+    def t3050_test_extended_frame_shadows_cached_global(self):
+        env = generate_global_env()
+        Parser('(define f (lambda (x) 1))').read().eval(env)
+        term = Parser('(f 5)').read()
+        assert(term.eval(env).pyvalue(env) == 1)
+        local = env.extend({'f': env.get('+')})
+        assert(term.eval(local).pyvalue(local) == 5)
+        assert(term.eval(env).pyvalue(env) == 1)
+
+    def t3060_test_local_set_not_cached_as_global(self):
+        env = generate_global_env()
+        Parser('(define f (lambda (x) 1))').read().eval(env)
+        term = Parser('(f 0)').read()
+        local = env.extend()
+        local.set('f', env.get('+'), with_create=True)
+        assert(term.eval(local).pyvalue(local) == 0)
+        assert(term.eval(env).pyvalue(env) == 1)
+
+    # test evaluation contexts
+    def eval_with_context(self, str, context):
+        prog = Parser(str)
+        result = None
+
+        env = generate_global_env()
+        while not prog.EOF():
+            result = context.eval(prog.read(), env)
+
+        return result.pyvalue(env, deep=True)
+
+    def t4000_test_context_counters(self):
+        context = EvalContext()
+        assert(self.eval_with_context('(define f (lambda (x) (+ x 1)))(f (f 1))', context) == 3)
+        assert(context.calls == 4)
+        assert(context.steps == 4)
+        assert(context.peak_depth == 3)
+
+    def t4005_test_context_peak_depth_follows_recursion(self):
+        context = EvalContext()
+        self.eval_with_context('(define fibo (lambda (n) (if (< n 2) 1 '
+                               '(+ (fibo (- n 1)) (fibo (- n 2))))))(fibo 15)', context)
+        assert(context.peak_depth == 30)
+
+    def t4010_test_context_reset(self):
+        context = EvalContext()
+        self.eval_with_context('(+ 1 (+ 1 1))(+ 1 1)', context)
+        assert(context.stats()['steps'] == 1)
+
+    @raises(ResourceLimitError)
+    def t4020_test_step_limit(self):
+        self.eval_with_context('(define fibo (lambda (n) (if (< n 2) 1 '
+                               '(+ (fibo (- n 1)) (fibo (- n 2))))))(fibo 20)',
+                               EvalContext(max_steps=1000))
+
+    @raises(ResourceLimitError)
+    def t4030_test_depth_limit(self):
+        self.eval_with_context('(define loop (lambda (x) (+ 1 (loop x))))(loop 1)',
+                               EvalContext(max_depth=50))
+
+    @raises(ResourceLimitError)
+    def t4040_test_timeout(self):
+        self.eval_with_context('(define fibo (lambda (n) (if (< n 2) 1 '
+                               '(+ (fibo (- n 1)) (fibo (- n 2))))))(fibo 20)',
+                               EvalContext(timeout=0.01))
+
+    @raises(ResourceLimitError)
+    def t4045_test_depth_limit_past_python_stack(self):
+        self.eval_with_context('(define loop (lambda (x) (+ 1 (loop x))))(loop 1)',
+                               EvalContext(max_depth=100000))
+
+    @raises(ResourceLimitError)
+    def t4046_test_unbounded_recursion_without_depth_limit(self):
+        self.eval_with_context('(define loop (lambda (x) (+ 1 (loop x))))(loop 1)',
+                               EvalContext(max_steps=10**6, timeout=5))
+
+    def t4050_test_limits_not_hit(self):
+        context = EvalContext(max_steps=1000, max_depth=50, timeout=10)
+        assert(self.eval_with_context('(+ 1 2)', context) == 3)
+
+    # test embedding interface
+    def t5000_test_run(self):
+        interp = Interpreter()
+        assert(interp.run('(define f (lambda (x) (* x 2)))(f 4)') == 8)
+
+    def t5010_test_compiled_eval(self):
+        expr = Interpreter().compile('(+ x y)', ['x', 'y'])
+        assert(expr.eval({'x': 1}, y=2) == 3)
+        assert(expr.eval(x=3, y=4) == 7)
+
+    def t5020_test_eval_many(self):
+        interp = Interpreter()
+        interp.run('(define f (lambda (x) (* x 2)))')
+        expr = interp.compile('(if (string? x) x (f x))', ['x'])
+        assert(expr.eval_many([{'x': 1}, {'x': 'a'}, {'x': 2}]) == [2, 'a', 4])
+        assert(expr.records == 3)
+
+    def t5030_test_eval_columns(self):
+        expr = Interpreter().compile('(list x (- x y))', ['x', 'y'])
+        assert(expr.eval_columns({'x': [5, 6], 'y': [1, 2]}) == [[5, 4], [6, 4]])
+
+    @raises(SyntaxError)
+    def t5035_test_eval_columns_length_mismatch(self):
+        expr = Interpreter().compile('(+ x y)', ['x', 'y'])
+        expr.eval_columns({'x': [1, 2, 3], 'y': [1]})
+
+    def t5040_test_input_shadows_global(self):
+        interp = Interpreter()
+        interp.run('(define x 1)')
+        expr = interp.compile('x', ['x'])
+        assert(expr.eval_many([{'x': 2}, {'x': 3}]) == [2, 3])
+        assert(interp.run('x') == 1)
+
+    def t5045_test_inputs_escaping_through_set(self):
+        interp = Interpreter()
+        interp.run('(define keep (list))')
+        expr = interp.compile('(set! keep (list x keep))', ['x'])
+        expr.eval_many([{'x': 1}, {'x': 2}, {'x': 3}])
+        assert(interp.run('keep') == [3, [2, [1, []]]])
+
+    def t5046_test_inputs_escaping_in_closures(self):
+        interp = Interpreter()
+        interp.run('(define keep (list))')
+        expr = interp.compile('(set! keep (list (lambda () x) keep))', ['x'])
+        expr.eval_many([{'x': 1}, {'x': 2}])
+        assert(interp.run('((car (car (cdr keep))))') == 1)
+
+    def t5047_test_token_inputs_are_not_modified(self):
+        expr = Interpreter().compile('(+ x 1)', ['x'])
+        token = ConstantInt(1)
+        assert(expr.eval_many([{'x': token}, {'x': ConstantInt(2)}]) == [2, 3])
+        assert(token.value == 1)
+
+    def t5048_test_function_results(self):
+        interp = Interpreter()
+        assert(isinstance(interp.run('(lambda (x) x)'), LambdaFunction))
+        expr = interp.compile('(list x (lambda () x))', ['x'])
+        result = expr.eval(x=1)
+        assert(result[0] == 1)
+        assert(isinstance(result[1], LambdaFunction))
+
+    def t5050_test_compiled_with_context(self):
+        context = EvalContext(max_steps=10)
+        expr = Interpreter(context=context).compile('(+ x 1)', ['x'])
+        assert(expr.eval_many([{'x': 1}, {'x': 2}, {'x': 3}]) == [2, 3, 4])
+        assert(context.steps == 3)
+        assert(context.calls == 3)
+
+    @raises(ResourceLimitError)
+    def t5055_test_compiled_batch_step_limit(self):
+        context = EvalContext(max_steps=10)
+        expr = Interpreter(context=context).compile('(+ x 1)', ['x'])
+        expr.eval_columns({'x': range(20)})
+
+    # test closures
+    def t6000_test_closure_captures_only_free_variables(self):
+        env = generate_global_env()
+        closure = Parser('(let ((big (list 1 2 3)) (y 1)) (lambda () y))').read().eval(env)
+        assert(closure.free == ('y',))
+        assert(closure.cells[0].value.pyvalue(env) == 1)
+
+    def t6005_test_closures_release_unused_values(self):
+        env = generate_global_env()
+        Parser('(define make (lambda (big) (let ((kept big) (y 1)) (lambda () y))))').read().eval(env)
+        make = env.get('make')
+
+        big = Constant(range(100000))
+        ref = weakref.ref(big)
+        for i in range(1000):
+            make.eval(env, big)
+        closures = [make.eval(env, big) for i in range(1000)]
+        del big
+        gc.collect()
+
+        assert(ref() is None)
+        assert(closures[0].eval(env).pyvalue(env) == 1)
+
+    def t6010_test_closure_shares_cells(self):
+        assert(self.eval_expr('(define counter ((lambda (n) (lambda () (begin (set! n (+ n 1)) n))) 0))'
+                              '(counter)(counter)') == 2)
+
+    def t6020_test_nested_closure(self):
+        assert(self.eval_expr('(define adder (lambda (x) (lambda (y) (lambda (z) (+ x y z)))))'
+                              '(((adder 1) 2) 3)') == 6)
+
+    @raises(SyntaxError)
+    def t6030_test_lexical_scope(self):
+        # y is not visible to f, even though the caller binds it
+        self.eval_expr('(define f (lambda () y))(let ((y 1)) (f))')
+
+    def t6050_test_letrec(self):
+        assert(self.eval_expr('(letrec ((f (lambda (n) (if (< n 1) 0 (+ n (f (- n 1))))))) (f 3))') == 6)
+
+    def t6060_test_letrec_mutual_recursion(self):
+        assert(self.eval_expr('(letrec ((even (lambda (n) (if (= n 0) 1 (odd (- n 1)))))'
+                              '         (odd (lambda (n) (if (= n 0) 0 (even (- n 1))))))'
+                              ' (even 10))') == 1)
+
+    @raises(SyntaxError)
+    def t6065_test_letrec_used_before_initialization(self):
+        self.eval_expr('(letrec ((a b) (b 1)) (+ a 1))')
+
+    @raises(SyntaxError)
+    def t6070_test_let_star_is_not_recursive(self):
+        self.eval_expr('(let* ((f (lambda (n) (if (< n 1) 0 (f (- n 1)))))) (f 3))')
+
+    def t6080_test_eval_quoted_local(self):
+        assert(self.eval_expr("(let ((y 1)) ((lambda () (eval 'y))))") == 1)